@@ -2,7 +2,6 @@ from tqdm import tqdm
 
 import transformers
 import torch
-import torch.nn.functional as F
 
 
 from lm_eval.api.model import LM
@@ -16,6 +15,7 @@ class HuggingfaceCausalLM(LM):
         pretrained="EleutherAI/pythia-70m-deduped",
         revision="main",
         batch_size=1,
+        parallelize=False,
     ):
         super().__init__()
 
@@ -39,12 +39,100 @@ class HuggingfaceCausalLM(LM):
                 else torch.device("cpu")
             )
 
-        self.hf_model = transformers.AutoModelForCausalLM.from_pretrained(
-            pretrained,
-            revision=revision,
-        ).to(self.device)
+        if torch.cuda.is_available():
+            # tf32 matmuls/convs (Ampere+) and the fused flash/mem-efficient
+            # scaled-dot-product kernels are free throughput for inference
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            if hasattr(torch.backends.cuda, "enable_flash_sdp"):
+                torch.backends.cuda.enable_flash_sdp(True)
+                torch.backends.cuda.enable_mem_efficient_sdp(True)
+
+        model_kwargs = {}
+
+        # fp32 weights double the memory bandwidth and skip the tensor cores;
+        # load in bf16 on Ampere+ (fp16 on older cards) and autocast the forward
+        self._autocast_dtype = None
+        if self.device.type == "cuda":
+            self._autocast_dtype = (
+                torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+            )
+            model_kwargs["torch_dtype"] = self._autocast_dtype
+
+        # shard the weights across all visible GPUs through accelerate's
+        # device_map instead of squeezing everything onto one device
+        if isinstance(parallelize, str):
+            parallelize = parallelize.lower() == "true"
+        if parallelize and torch.cuda.device_count() > 1:
+            try:
+                import accelerate  # noqa: F401
+
+                model_kwargs["device_map"] = "auto"
+            except ImportError:
+                print("parallelize=True requires accelerate; loading on one device")
+
+        try:
+            # flash-attention-2 gives us the varlen kernel, which lets us pack
+            # variable-length samples into one row and skip padding compute
+            import flash_attn  # noqa: F401
+
+            model_kwargs["attn_implementation"] = "flash_attention_2"
+        except ImportError:
+            pass
+
+        try:
+            self.hf_model = transformers.AutoModelForCausalLM.from_pretrained(
+                pretrained,
+                revision=revision,
+                **model_kwargs,
+            )
+        except (ValueError, ImportError):
+            # this architecture has no flash-attention-2 path; fall back to
+            # the default attention implementation
+            model_kwargs.pop("attn_implementation", None)
+            self.hf_model = transformers.AutoModelForCausalLM.from_pretrained(
+                pretrained,
+                revision=revision,
+                **model_kwargs,
+            )
+        if "device_map" not in model_kwargs:
+            self.hf_model = self.hf_model.to(self.device)
+        else:
+            # accelerate already dispatched the shards; inputs go to the first
+            # device and hooks move activations between GPUs
+            self._device = torch.device("cuda:0")
         self.hf_model.eval()
 
+        # the packed path relies on transformers deriving cu_seqlens from
+        # position-id resets (prepare_fa2_from_position_ids, added in 4.43);
+        # on older versions the [1, sum(lens)] row silently attends across
+        # samples, so require the version rather than risk corrupted numbers
+        try:
+            transformers_version = tuple(
+                int(part) for part in transformers.__version__.split(".")[:2]
+            )
+        except ValueError:
+            transformers_version = (0, 0)
+        self._use_packed = (
+            getattr(self.hf_model.config, "_attn_implementation", None)
+            == "flash_attention_2"
+            and transformers_version >= (4, 43)
+        )
+
+        # JIT-fuse the forward to cut per-op dispatch and kernel-launch
+        # overhead; dynamic=True so variable sequence lengths don't recompile.
+        # generate() stays eager - compile doesn't help it without a static
+        # kv-cache. Compilation is lazy, so backend failures only show up at
+        # the first call; _model_call handles the eager fallback.
+        self._compiled_forward = None
+        if hasattr(torch, "compile") and torch.__version__ >= "2.1":
+            self._compiled_forward = torch.compile(
+                self.hf_model,
+                mode="reduce-overhead",
+                dynamic=True,
+                fullgraph=False,
+            )
+
         self.tokenizer = transformers.AutoTokenizer.from_pretrained(
             pretrained,
             revision=revision,
@@ -53,20 +141,92 @@ class HuggingfaceCausalLM(LM):
 
         self.vocab_size = self.tokenizer.vocab_size
 
+        # lazily grown pinned staging buffer shared across batches (see
+        # _staging_buffer)
+        self._scratch_inps = None
+
+        # static kv-cache for generate(): cache_implementation="static" exists
+        # wherever StaticCache does (transformers >= 4.38, including 5.x where
+        # the private _supports_static_cache flag was removed - when the flag
+        # is absent we assume support and let the first generate() call probe
+        # it, see _model_generate)
+        self._use_static_cache = (
+            self.device.type == "cuda"
+            and hasattr(transformers, "StaticCache")
+            and getattr(self.hf_model, "_supports_static_cache", True)
+        )
+
         # TODO: add multi-gpu (FSDP and/or Accelerate)
         # multithreading and batching
-        if batch_size == "auto":
-            auto_batch_size = 64
+        if isinstance(batch_size, str) and batch_size.startswith("auto"):
+            # "auto" searches up to the default cap; "auto:N" caps the search at N
+            if ":" in batch_size:
+                batch_size = self._detect_batch_size(
+                    max_probe=int(batch_size.split(":", 1)[1])
+                )
+            else:
+                batch_size = self._detect_batch_size()
+        self.batch_size_per_gpu = int(batch_size)
+
+    def _detect_batch_size(self, max_probe=512):
+        """Find the largest batch size that survives a worst-case forward pass
+        (every row at max_length): double until the first OOM, then binary
+        search the boundary between the last fit and the first failure.
+        """
+        if self.device.type != "cuda":
+            # probing is only meaningful against a fixed GPU memory budget,
+            # but an explicit auto:N cap still applies
+            return min(64, max_probe)
+
+        def _fits(n):
             try:
-                random_sample = torch.randint(0, self.vocab_size,
-                                             (auto_batch_size, self.hf_model.config.hidden_size)
-                                             ).to(self.device)
-                self._model_call(random_sample)
-                batch_size = auto_batch_size
+                probe = torch.randint(
+                    0, self.vocab_size, (n, self.max_length), dtype=torch.long
+                ).to(self.device)
+                self._model_call(probe)
+                return True
             except torch.cuda.OutOfMemoryError:
-                print("Out of memory, reducing batch size by factor of 2...")
-                auto_batch_size = max(1, auto_batch_size // 2)
-        self.batch_size_per_gpu = batch_size 
+                torch.cuda.empty_cache()
+                return False
+
+        lo, hi = 1, 2
+        while hi <= max_probe and _fits(hi):
+            lo = hi
+            hi *= 2
+
+        if hi <= max_probe:
+            # lo fits, hi OOMs - binary search between them
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if _fits(mid):
+                    lo = mid
+                else:
+                    hi = mid
+
+        torch.cuda.empty_cache()
+        print(f"Auto-detected batch size: {lo}")
+        return lo
+
+    def _staging_buffer(self, rows, cols):
+        """Return a zeroed [rows, cols] long view into one shared pinned CPU
+        buffer, growing it when a batch needs more room. Pinning is only paid
+        once this way, and the allocator stops churning a fresh staging tensor
+        every iteration."""
+        buf = self._scratch_inps
+        if buf is None or buf.shape[0] < rows or buf.shape[1] < cols:
+            buf = torch.zeros(
+                (
+                    max(rows, buf.shape[0] if buf is not None else 0),
+                    max(cols, buf.shape[1] if buf is not None else 0),
+                ),
+                dtype=torch.long,
+                pin_memory=self.device.type == "cuda",
+            )
+            self._scratch_inps = buf
+
+        view = buf[:rows, :cols]
+        view.zero_()
+        return view
 
     @property
     def eot_token_id(self):
@@ -100,6 +260,14 @@ class HuggingfaceCausalLM(LM):
         # TODO: encode inputs batch-by-batch with padding
         return self.tokenizer.encode(string, add_special_tokens=False)
 
+    def tok_encode_batch(self, strings):
+        # fast tokenizers parallelize over the batch in Rust, so one call over
+        # all strings is much cheaper than a Python loop of encode() calls
+        if not strings:
+            # the tokenizer raises on an empty batch
+            return []
+        return self.tokenizer(strings, add_special_tokens=False)["input_ids"]
+
     def tok_decode(self, tokens):
         return self.tokenizer.decode(tokens)
 
@@ -111,26 +279,106 @@ class HuggingfaceCausalLM(LM):
         returns: a torch tensor of shape [batch, sequence, vocab] with the
         logits returned from the model
         """
-        with torch.no_grad():
+        with torch.inference_mode(), torch.autocast(
+            device_type=self.device.type,
+            dtype=self._autocast_dtype,
+            enabled=self._autocast_dtype is not None,
+        ):
+            if self._compiled_forward is not None:
+                # torch.compile is lazy - a broken backend (missing compiler,
+                # unsupported op) only raises here, at the first real forward,
+                # so this is where the eager fallback has to live
+                try:
+                    return self._compiled_forward(inps)[0]
+                except Exception as e:
+                    print(f"compiled forward failed, falling back to eager: {e}")
+                    self._compiled_forward = None
             return self.hf_model(inps)[0]
 
-    def _model_generate(self, context, max_length, eos_token_id):
-        # TODO: allow users to pass other kwargs to generate() including temperature sampling, beam search, etc...
-        return self.hf_model.generate(
-            context, max_length=max_length, eos_token_id=eos_token_id, do_sample=False
+    def _model_call_packed(self, token_lists):
+        """
+        token_lists: a list of per-sample token id lists of varying length
+
+        Packs all samples into one [1, sum(lens)] row with position_ids that
+        restart at 0 for each sample. The flash-attention-2 integration in
+        transformers recovers cu_seqlens from the position_id resets and runs
+        the varlen kernel, so there is no cross-sample attention and no
+        padding compute at all.
+
+        returns: a torch tensor of shape [1, sum(lens), vocab] with the
+        logits returned from the model
+        """
+        flat = []
+        positions = []
+        for toks in token_lists:
+            flat.extend(toks)
+            positions.extend(range(len(toks)))
+
+        input_ids = (
+            torch.as_tensor(flat, dtype=torch.long).unsqueeze(0).to(self.device)
         )
+        position_ids = (
+            torch.as_tensor(positions, dtype=torch.long).unsqueeze(0).to(self.device)
+        )
+
+        with torch.inference_mode():
+            return self.hf_model(input_ids, position_ids=position_ids)[0]
+
+    def _model_generate(self, context, max_length, eos_token_id, attention_mask=None):
+        # TODO: allow users to pass other kwargs to generate() including temperature sampling, beam search, etc...
+        generate_kwargs = {}
+        if attention_mask is not None:
+            generate_kwargs["attention_mask"] = attention_mask
+        if self._use_static_cache:
+            # a static kv-cache keeps the decode-step shapes fixed, so the
+            # compiled forward can be captured as a CUDA graph instead of
+            # re-launching every kernel per generated token
+            generate_kwargs["cache_implementation"] = "static"
+
+        try:
+            return self.hf_model.generate(
+                context,
+                max_length=max_length,
+                eos_token_id=eos_token_id,
+                do_sample=False,
+                use_cache=True,
+                **generate_kwargs,
+            )
+        except (ValueError, TypeError) as e:
+            if "cache_implementation" not in generate_kwargs:
+                raise
+            # this model/transformers combo can't run a static cache after
+            # all - remember that and retry with the default dynamic cache
+            print(f"static kv-cache unavailable, using dynamic cache: {e}")
+            self._use_static_cache = False
+            generate_kwargs.pop("cache_implementation")
+            return self.hf_model.generate(
+                context,
+                max_length=max_length,
+                eos_token_id=eos_token_id,
+                do_sample=False,
+                use_cache=True,
+                **generate_kwargs,
+            )
 
     def loglikelihood(self, requests):
-        new_reqs = []
+        contexts = []
+        continuations = []
         for req in requests:
             context, continuation = req.inps # get model loglikelihood inputs from each request
+            contexts.append(context)
+            continuations.append(continuation)
+
+        context_encs = self.tok_encode_batch(contexts)
+        continuation_encs = self.tok_encode_batch(continuations)
+
+        new_reqs = []
+        for context, continuation, context_enc, continuation_enc in zip(
+            contexts, continuations, context_encs, continuation_encs
+        ):
             if context == "":
                 # end of text as context
                 context_enc = [self.eot_token_id]
-            else:
-                context_enc = self.tok_encode(context)
-
-            continuation_enc = self.tok_encode(continuation)
 
             new_reqs.append(((context, continuation), context_enc, continuation_enc))
 
@@ -141,13 +389,17 @@ class HuggingfaceCausalLM(LM):
 
     def loglikelihood_rolling(self, requests):
 
+        # tokenize every document once up front (batched through the fast
+        # tokenizer) instead of encoding inside the per-document loop
+        token_lists = self.tok_encode_batch([string for (string,) in requests])
+
         loglikelihoods = []
-        for (string,) in tqdm(requests):
+        for token_list in tqdm(token_lists):
             rolling_token_windows = list(
                 map(
                     utils.make_disjoint_window,
                     utils.get_rolling_token_windows(
-                        token_list=self.tok_encode(string),
+                        token_list=token_list,
                         prefix_token=self.eot_token_id,
                         max_seq_len=self.max_length,
                         context_len=1,
@@ -186,20 +438,45 @@ class HuggingfaceCausalLM(LM):
             toks = x[1] + x[2]
             return -len(toks), tuple(toks)
 
+        def _bucket(length):
+            # quantize lengths to the nearest power of two; since the reordered
+            # requests are sorted descending, samples sharing a bucket are
+            # consecutive and pad to roughly the same length
+            return 1 << max(length - 1, 1).bit_length()
+
         # TODO: automatic (variable) batch size detection for vectorization
         re_ord = utils.Reorderer(requests, _collate)
-        for chunk in utils.chunks(
-            tqdm(re_ord.get_reordered(), disable=disable_tqdm), self.batch_size
-        ):
-            inps = []
+        reordered = re_ord.get_reordered()
+
+        # precompute chunk boundaries as (start, end) index pairs - cutting a
+        # new chunk at the batch-size limit or at a bucket boundary, so one
+        # long outlier doesn't set padding_length for a whole batch of short
+        # samples. Slicing the materialized list by index is cheaper than
+        # threading every element through stacked tqdm/generator machinery.
+        boundaries = []
+        start = 0
+        prev_bucket = None
+        for i, x in enumerate(reordered):
+            bucket = _bucket(len(x[1]) + len(x[2]))
+            if i > start and (
+                i - start == self.batch_size or bucket != prev_bucket
+            ):
+                boundaries.append((start, i))
+                start = i
+            prev_bucket = bucket
+        if start < len(reordered):
+            boundaries.append((start, len(reordered)))
+
+        pbar = tqdm(total=len(reordered), disable=disable_tqdm)
+        for start, end in boundaries:
+            chunk = reordered[start:end]
+            token_lists = []
             cont_toks_list = []
             inplens = []
 
-            padding_length = None
-
-            # because vectorizing is annoying, we first convert each (context, continuation) pair to padded
-            # tensors, then we pack them together into a batch, call the model, and then pick it all apart
-            # again because vectorizing is annoying
+            # because vectorizing is annoying, we first truncate each (context, continuation) pair to
+            # a token list, then we pack them all into one preallocated batch tensor, call the model,
+            # and then pick it all apart again because vectorizing is annoying
 
             for _, context_enc, continuation_enc in chunk:
                 # sanity check
@@ -215,66 +492,145 @@ class HuggingfaceCausalLM(LM):
                 # cont_toks      4 5 6 7 8 9      [:, -len(continuation_enc):, :self.vocab_size] slice
 
                 # when too long to fit in context, truncate from the left
-                inp = torch.tensor(
-                    (context_enc + continuation_enc)[-(self.max_length + 1) :][:-1],
-                    dtype=torch.long,
-                ).to(self.device)
-                (inplen,) = inp.shape
-
-                cont = continuation_enc
-
+                toks = (context_enc + continuation_enc)[-(self.max_length + 1) :][:-1]
+
+                token_lists.append(toks)
+                cont_toks_list.append(continuation_enc)
+                inplens.append(len(toks))
+
+            # the position-id-reset detection in transformers needs at least
+            # one decreasing step; a chunk of all length-1 samples gives
+            # positions [0, 0, ...], which looks unpacked and would attend
+            # across samples - send those through the rectangular path
+            if self._use_packed and max(inplens) > 1:
+                # varlen path: one [1, sum(lens)] row, split back per sample
+                packed_logits = self._model_call_packed(
+                    token_lists
+                )  # [1, sum(lens), vocab]
+
+                # the per-sample slices are ragged, so score them one by one;
+                # upcast each slice to fp32 so logsumexp is numerically stable
+                # after the bf16/fp16 forward
+                batch_logprobs = []
+                batch_greedy = []
+                offset = 0
+                for inplen, cont_toks in zip(inplens, cont_toks_list):
+                    contlen = len(cont_toks)
+                    logits = packed_logits[
+                        0, offset + inplen - contlen : offset + inplen
+                    ].float()  # [seq, vocab]
+                    offset += inplen
+
+                    greedy_tokens = logits.argmax(dim=-1)
+                    cont_toks = torch.as_tensor(
+                        cont_toks, dtype=torch.long, device=logits.device
+                    )  # [seq]
+                    batch_greedy.append((greedy_tokens == cont_toks).all())
+
+                    # log p(tok) = logit[tok] - logsumexp(logits)
+                    batch_logprobs.append(
+                        (
+                            torch.gather(logits, 1, cont_toks.unsqueeze(-1)).squeeze(
+                                -1
+                            )
+                            - torch.logsumexp(logits, dim=-1)
+                        ).sum()
+                    )
+
+                # one host transfer per batch
+                batch_logprobs = torch.stack(batch_logprobs).cpu().tolist()
+                batch_greedy = torch.stack(batch_greedy).cpu().tolist()
+            else:
                 # since in _collate we make sure length is descending, the longest is always the first one.
-                padding_length = (
-                    padding_length if padding_length is not None else inplen
+                padding_length = max(inplens)
+                if self._compiled_forward is not None:
+                    # round the sequence dim up to the bucket's power of two
+                    # (capped at max_length) so the compiled forward sees a
+                    # handful of distinct shapes instead of one per batch -
+                    # each recompile or CUDA-graph re-capture costs far more
+                    # than the few extra padded columns
+                    padding_length = min(_bucket(padding_length), self.max_length)
+
+                # one shared pinned CPU buffer + one async H2D copy instead of
+                # per-sample tensor/zeros/cat/.to() round trips. Reusing the
+                # buffer is safe: the previous chunk's scoring ends with a
+                # blocking .cpu() sync, so its upload has already landed by the
+                # time we refill here.
+                batched_inps = self._staging_buffer(
+                    len(chunk), padding_length
+                )  # [batch, padding_length]
+                for i, toks in enumerate(token_lists):
+                    batched_inps[i, : inplens[i]].copy_(
+                        torch.as_tensor(toks, dtype=torch.long)
+                    )
+                batched_inps = batched_inps.to(self.device, non_blocking=True)
+
+                multi_logits = self._model_call(
+                    batched_inps
+                )  # [batch, padding_length, vocab]
+
+                # rectangular rows all live in one tensor, so slice every
+                # continuation window with a single gather instead of a
+                # python loop over samples
+                contlens = torch.as_tensor(
+                    [len(cont) for cont in cont_toks_list], dtype=torch.long
                 )
+                max_contlen = int(contlens.max())
 
-                # pad length from seq to padding_length
-                inp = torch.cat(
-                    [
-                        inp,  # [seq]
-                        torch.zeros(padding_length - inplen, dtype=torch.long).to(
-                            inp.device
-                        ),  # [padding_length - seq]
-                    ],
-                    dim=0,
-                )
-
-                inps.append(inp.unsqueeze(0))  # [1, padding_length]
-                cont_toks_list.append(cont)
-                inplens.append(inplen)
-
-            batched_inps = torch.cat(inps, dim=0)  # [batch, padding_length
-            multi_logits = F.log_softmax(
-                self._model_call(batched_inps), dim=-1
-            ).cpu()  # [batch, padding_length, vocab]
-
-            for (cache_key, _, _), logits, inp, inplen, cont_toks in zip(
-                chunk, multi_logits, inps, inplens, cont_toks_list
-            ):
-
-                # Slice to original seq length
-                contlen = len(cont_toks)
-                logits = logits[inplen - contlen : inplen].unsqueeze(
-                    0
-                )  # [1, seq, vocab]
-
-                # Check if per-token argmax is exactly equal to continuation
-                greedy_tokens = logits.argmax(dim=-1)
-                cont_toks = torch.tensor(cont_toks, dtype=torch.long).unsqueeze(
+                # position of each continuation token within its row; padded
+                # slots point at index 0 and get masked out below
+                starts = torch.as_tensor(inplens, dtype=torch.long) - contlens
+                pos = starts.unsqueeze(1) + torch.arange(max_contlen)
+                cont_mask = torch.arange(max_contlen).unsqueeze(
                     0
-                )  # [1, seq]
-                max_equal = (greedy_tokens == cont_toks).all()
-
-                # Obtain log-probs at the corresponding continuation token indices
-                # last_token_slice = logits[:, -1, :].squeeze(0).tolist()
-                logits = torch.gather(logits, 2, cont_toks.unsqueeze(-1)).squeeze(
-                    -1
-                )  # [1, seq]
+                ) < contlens.unsqueeze(1)
+                pos = pos.masked_fill(~cont_mask, 0)
 
-                # Answer: (log prob, is-exact-match)
-                answer = (float(logits.sum()), bool(max_equal))
+                cont_toks_pad = torch.zeros(
+                    (len(chunk), max_contlen), dtype=torch.long
+                )
+                for i, cont in enumerate(cont_toks_list):
+                    cont_toks_pad[i, : len(cont)].copy_(
+                        torch.as_tensor(cont, dtype=torch.long)
+                    )
+
+                pos = pos.to(self.device)
+                cont_mask = cont_mask.to(self.device)
+                cont_toks_pad = cont_toks_pad.to(self.device)
+
+                # [batch, max_contlen, vocab] in fp32 - upcasting after the
+                # bf16/fp16 forward keeps logsumexp numerically stable
+                cont_logits = torch.gather(
+                    multi_logits,
+                    1,
+                    pos.unsqueeze(-1).expand(-1, -1, multi_logits.shape[-1]),
+                ).float()
 
-                res.append(answer)
+                # Check if per-token argmax is exactly equal to continuation
+                greedy_tokens = cont_logits.argmax(dim=-1)
+                max_equal = ((greedy_tokens == cont_toks_pad) | ~cont_mask).all(
+                    dim=-1
+                )  # [batch]
+
+                # log p(tok) = logit[tok] - logsumexp(logits), summed over the
+                # (unpadded) continuation positions
+                logprobs = torch.gather(
+                    cont_logits, 2, cont_toks_pad.unsqueeze(-1)
+                ).squeeze(-1) - torch.logsumexp(
+                    cont_logits, dim=-1
+                )  # [batch, max_contlen]
+                logprobs = (logprobs * cont_mask).sum(dim=-1)  # [batch]
+
+                # one host transfer per batch
+                batch_logprobs = logprobs.cpu().tolist()
+                batch_greedy = max_equal.cpu().tolist()
+
+            # Answers: (log prob, is-exact-match)
+            for logprob, greedy in zip(batch_logprobs, batch_greedy):
+                res.append((logprob, bool(greedy)))
+
+            pbar.update(end - start)
+        pbar.close()
 
         return re_ord.get_original(res)
 
@@ -284,35 +640,84 @@ class HuggingfaceCausalLM(LM):
         #       multiple tokens or that span multiple tokens correctly
         res = []
 
+        # Reorderer calls the collate fn more than once per request, and the
+        # generation loop needs the tokens again - encode the unique contexts
+        # exactly once, in a single batched tokenizer call
+        unique_contexts = list(dict.fromkeys(context for context, _ in requests))
+        context_enc_cache = dict(
+            zip(unique_contexts, self.tok_encode_batch(unique_contexts))
+        )
+
         def _collate(x):
-            toks = self.tok_encode(x[0])
-            return len(toks), x[0]
+            return len(context_enc_cache[x[0]]), x[0]
 
         re_ord = utils.Reorderer(requests, _collate)
 
-        for context, until in tqdm(re_ord.get_reordered()):
+        def _until_key(x):
+            until = x[1]
+            return (until,) if isinstance(until, str) else tuple(until)
+
+        def _until_batches(gen, n):
+            # like utils.chunks, but also cut a new batch when `until` changes
+            # so every row in a generate() call shares one stopping token
+            arr = []
+            arr_key = None
+            for x in gen:
+                key = _until_key(x)
+                if arr and (len(arr) == n or key != arr_key):
+                    yield arr
+                    arr = []
+                arr.append(x)
+                arr_key = key
+            if arr:
+                yield arr
+
+        for batch in _until_batches(tqdm(re_ord.get_reordered()), self.batch_size):
+            until = batch[0][1]
             if isinstance(until, str):
                 until = [until]
 
             (primary_until,) = self.tok_encode(until[0])
 
-            context_enc = torch.tensor(
-                [self.tok_encode(context)[self.max_gen_toks - self.max_length :]]
-            ).to(self.device)
+            token_lists = [
+                context_enc_cache[context][self.max_gen_toks - self.max_length :]
+                for context, _ in batch
+            ]
+            max_context_len = max(len(toks) for toks in token_lists)
+
+            # left-pad with EOT so every row starts generating at the same
+            # position; the attention mask hides the padding from the model
+            context_enc = torch.full(
+                (len(batch), max_context_len), self.eot_token_id, dtype=torch.long
+            )
+            attention_mask = torch.zeros(
+                (len(batch), max_context_len), dtype=torch.long
+            )
+            for i, toks in enumerate(token_lists):
+                context_enc[i, max_context_len - len(toks) :].copy_(
+                    torch.as_tensor(toks, dtype=torch.long)
+                )
+                attention_mask[i, max_context_len - len(toks) :] = 1
+            context_enc = context_enc.to(self.device)
+            attention_mask = attention_mask.to(self.device)
 
             cont = self._model_generate(
-                context_enc, context_enc.shape[1] + self.max_gen_toks, primary_until
+                context_enc,
+                max_context_len + self.max_gen_toks,
+                primary_until,
+                attention_mask=attention_mask,
             )
 
-            s = self.tok_decode(cont[0].tolist()[context_enc.shape[1] :])
+            for (context, _), cont_toks in zip(batch, cont):
+                s = self.tok_decode(cont_toks.tolist()[max_context_len:])
 
-            for term in until:
-                s = s.split(term)[0]
+                for term in until:
+                    s = s.split(term)[0]
 
-            # partial caching
-            self.cache_hook.add_partial("greedy_until", (context, until), s)
+                # partial caching
+                self.cache_hook.add_partial("greedy_until", (context, until), s)
 
-            res.append(s)
+                res.append(s)
 
         return re_ord.get_original(res)
 